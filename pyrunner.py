@@ -11,21 +11,30 @@ from __future__ import print_function
 
 import sys
 import os
-import inspect
-
-from textwrap import fill
-from subprocess import Popen, PIPE, CalledProcessError
 
+from types import FunctionType
 from contextlib import contextmanager
 from collections import namedtuple
 
-import argparse
+try:
+    from sys import intern
+except ImportError: # python 2, where intern is a builtin
+    pass
+
+try:
+    _string_types = basestring
+except NameError: # python 3
+    _string_types = str
 
 RunResult = namedtuple('RunResult', ['returncode', 'stdout', 'stderr'])
 
 # --- constants
 DEFAULT_ACTION = 'default'
 
+# code object flags, see _arg_layout
+_CO_VARARGS = 0x04
+_CO_VARKEYWORDS = 0x08
+
 @contextmanager
 def silence():
     """
@@ -78,188 +87,527 @@ def run(*args, **kwargs):
 
     timeout: millisecond float
         specifies how long to wait before terminating the given command  
+
+    stream: bool
+        when true, the command's stdout and stderr are written to sys.stdout
+        line by line as they are produced instead of being buffered in memory.
+        The returned RunResult then has None for both stdout and stderr.
+        stdout can't be given together with stream, since the output has to
+        be read through a pipe.
     """
-    assert len(args) > 0
+    from subprocess import Popen, PIPE
 
-    arguments = []
+    assert len(args) > 0
 
     input = kwargs.pop('input', None)
+    timeout = kwargs.pop('timeout', None)
+    stream = kwargs.pop('stream', False)
 
-    if len(args) == 1:
-        if isinstance(args[0], basestring):
-            arguments = args[0].split()
-    else:
-        for i in args:
-            if isinstance(i, (list, tuple)):
-                for j in i:
-                    arguments.append(j)
-            else:
-                arguments.append(i)
+    arguments = _flatten(args)
 
     def set_default_kwarg(key, default):    
         kwargs[key] = kwargs.get(key, default)
 
     set_default_kwarg('stdin', PIPE)
-    set_default_kwarg('stdout', PIPE)
-    set_default_kwarg('stderr', PIPE)
+    if stream:
+        from subprocess import STDOUT
 
+        if 'stdout' in kwargs:
+            raise ValueError('stdout cannot be given with stream=True')
+        kwargs['stdout'] = PIPE
+        set_default_kwarg('stderr', STDOUT)
+    else:
+        set_default_kwarg('stdout', PIPE)
+        set_default_kwarg('stderr', PIPE)
 
     proc = Popen(arguments, **kwargs)
-    stdout, stderr = proc.communicate(input)
+    timer = _kill_after(proc, timeout)
+    try:
+        if stream:
+            return RunResult(_stream(proc, input), None, None)
+        stdout, stderr = proc.communicate(input)
+    finally:
+        if timer is not None:
+            timer.cancel()
 
     return RunResult(proc.returncode, stdout, stderr)
 
+def run_exec(*args):
+    """
+    Replaces the current process with the given command, which is looked up
+    on the PATH. The arguments are interpreted as for run(). This function
+    never returns, so it is only useful as the last step of a task.
+
+    Example
+    -------
+    def deploy():
+        run('make build')
+        run_exec('./start.sh')
+    """
+    assert len(args) > 0
+
+    arguments = _flatten(args)
+
+    # anything still buffered would be lost when the process image is replaced
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.execvp(arguments[0], arguments)
+
 # --- internally used functions
-def _patch_popen(Popen):
+def _flatten(args):
     """
-    Patches Popen.communicate to take a timeout option that allows a process to
-    be timed out. The timeput is a millisecond float
+    Turns the positional arguments of run() into an argument list. A single
+    string is split on whitespace, otherwise lists and tuples are spliced in.
     """
-    from threading import Timer
-    _communicate = Popen.communicate
-
-    def communicate(self, *args, **kwargs):
-        timeout = kwargs.pop('timeout', None)
-
-        if timeout is not None:
-            timeout /= 1000.0
-            timer = Timer(timeout, self.kill)
-            try:
-                timer.start()
-                return _communicate(self, *args, **kwargs)
-            finally:
-                timer.cancel()
+    if len(args) == 1 and isinstance(args[0], _string_types):
+        return args[0].split()
+
+    arguments = []
+    append = arguments.append
+    extend = arguments.extend
+    for i in args:
+        if isinstance(i, (list, tuple)):
+            extend(i)
         else:
-            return _communicate(self, *args, **kwargs)
+            append(i)
+    return arguments
 
-    Popen.communicate = communicate
+def _kill_after(proc, timeout):
+    """
+    Starts a Timer that kills proc once timeout, a millisecond float, has
+    passed. Returns the Timer, or None when timeout is None.
+    """
+    if timeout is None:
+        return None
+
+    from threading import Timer
+    timer = Timer(timeout / 1000.0, proc.kill)
+    timer.start()
+    return timer
+
+def _feed(stdin, input):
+    """
+    Writes input to stdin and closes it. A broken pipe is ignored, as in
+    Popen.communicate, since the command may exit without reading its input.
+    """
+    import errno
+
+    try:
+        try:
+            if input is not None:
+                stdin.write(input)
+        finally:
+            stdin.close()
+    except (IOError, OSError) as e:
+        if e.errno not in (errno.EPIPE, errno.EINVAL):
+            raise
+
+def _stream(proc, input=None):
+    """
+    Copies the output of proc to sys.stdout line by line and waits for it
+    to exit. Returns the return code.
+    """
+    feeder = None
+    if proc.stdin is not None:
+        # fed from a thread, so that a command which writes output while it
+        # reads a large input can't block on us and we on it
+        from threading import Thread
+        feeder = Thread(target=_feed, args=(proc.stdin, input))
+        feeder.daemon = True
+        feeder.start()
+
+    while True:
+        line = proc.stdout.readline()
+        if not line:
+            break
+        out = sys.stdout
+        if isinstance(line, bytes) and bytes is not str: # python 3
+            if hasattr(out, 'buffer'):
+                out = out.buffer
+            else: # a text-only stream, such as a StringIO capturing output
+                line = line.decode(getattr(out, 'encoding', None) or 'utf-8', 'replace')
+        out.write(line)
+        out.flush()
+
+    proc.stdout.close()
+    returncode = proc.wait()
+    if feeder is not None:
+        feeder.join()
+    return returncode
+
+USAGE = """\
+usage: pyrunner.py [-h] [-H] [-l] [function [function ...]]
+
+A script for writing and automating tasks in python
+
+positional arguments:
+  function
+
+optional arguments:
+  -h, --help    show this help message and exit
+  -H, --hidden  show functions which have a name starting with _ (underscore)
+  -l, --list    lists all the available functions
+"""
+
+ParsedArgs = namedtuple('ParsedArgs', ['function', 'list', 'hidden'])
+
+# option letters and long option names, see parse_args
+_SHORT_OPTIONS = {'h': 'help', 'H': 'hidden', 'l': 'list'}
+_LONG_OPTIONS = ('help', 'hidden', 'list')
+
+def _usage_error(message):
+    sys.stderr.write(USAGE.splitlines()[0] + '\n')
+    sys.stderr.write('pyrunner.py: error: {}\n'.format(message))
+    sys.exit(2)
 
 def parse_args(args):
-    parser = argparse.ArgumentParser(prog='pyrunner.py', 
-                                     description='A script for writing and automating tasks in python')
+    """
+    Parses the command line like argparse would: short options may be bundled
+    (-lH), long options may be abbreviated (--hid) and everything after --
+    is taken as a function call.
+    """
+    function = []
+    options = set()
+
+    args = iter(args)
+    for a in args:
+        if a == '--':
+            function.extend(args)
+            break
+        elif a.startswith('--'):
+            if a[2:] in _LONG_OPTIONS:
+                matches = [a[2:]]
+            else:
+                matches = [o for o in _LONG_OPTIONS if o.startswith(a[2:])]
+            if not matches:
+                _usage_error('unrecognized arguments: {}'.format(a))
+            if len(matches) > 1:
+                _usage_error('ambiguous option: {} could match {}'.format(
+                    a, ', '.join('--' + o for o in matches)))
+            found = matches
+        elif a.startswith('-') and len(a) > 1:
+            found = []
+            for c in a[1:]:
+                if c not in _SHORT_OPTIONS:
+                    _usage_error('unrecognized arguments: {}'.format(a))
+                found.append(_SHORT_OPTIONS[c])
+        else:
+            function.append(a)
+            continue
+
+        if 'help' in found:
+            sys.stdout.write(USAGE)
+            sys.exit(0)
+        options.update(found)
+
+    return ParsedArgs(function, 'list' in options, 'hidden' in options)
 
-    parser.add_argument('function', nargs='*')
-    parser.add_argument('-H', '--hidden',
-                        help='show functions which have a name starting with _ (underscore)',
-                        action='store_true')
-    parser.add_argument('-l', '--list', 
-                        help='lists all the available functions',
-                        action='store_true')
+# code object -> (args, varargs, kwonly, keywords), see _arg_layout
+_arg_layout_cache = {}
 
-    return parser.parse_args(args)
+def _arg_layout(code):
+    """
+    returns the positional, *, keyword-only and ** argument names of a code
+    object. Default values live on the function, so they aren't part of this.
+    """
+    layout = _arg_layout_cache.get(code)
+    if layout is not None:
+        return layout
+
+    names = code.co_varnames
+    argcount = code.co_argcount
+    kwonlycount = getattr(code, 'co_kwonlyargcount', 0) # python 3 only
 
+    args = names[:argcount]
+    kwonly = names[argcount:argcount + kwonlycount]
+    index = argcount + kwonlycount
 
+    varargs = keywords = None
+    if code.co_flags & _CO_VARARGS:
+        varargs = names[index]
+        index += 1
+    if code.co_flags & _CO_VARKEYWORDS:
+        keywords = names[index]
+
+    layout = _arg_layout_cache[code] = (args, varargs, kwonly, keywords)
+    return layout
 
 def _build_func_text(function, name=None):
-    spec = inspect.getargspec(function)
-    doc = inspect.getdoc(function)
     name = name or function.__name__
-    args = list(spec.args)
+    args, varargs, kwonly, keywords = _arg_layout(function.__code__)
 
     NO_DEFAULT = object()
-    defaults = spec.defaults or []
-    defaults = [NO_DEFAULT]*(len(args) - len(defaults)) + list(defaults)
-
-    if spec.varargs:
-        args += [spec.varargs]
-        defaults += [NO_DEFAULT]
-
-    if spec.keywords:
-        args += [spec.keywords]
-        defaults += [NO_DEFAULT]
-
-    line = name + '('
-    for i, (arg, dv) in enumerate(zip(args, defaults)):
-        if arg  == spec.varargs:
-            line += '*' + arg
-        elif arg == spec.keywords:
-            line += '**' + arg
-        else:
-            line += arg
-        
-        if dv != NO_DEFAULT:
-            line += '='
-            line += repr(dv)
-        line += ', '
+    defaults = function.__defaults__ or ()
+    defaults = (NO_DEFAULT,)*(len(args) - len(defaults)) + defaults
+    kwdefaults = getattr(function, '__kwdefaults__', None) or {}
 
-    if defaults:
-        line = line[:-2]
+    def format_arg(arg, dv):
+        if dv is NO_DEFAULT:
+            return arg
+        return '{}={!r}'.format(arg, dv)
 
-    line += ')'
+    parts = [format_arg(arg, dv) for arg, dv in zip(args, defaults)]
 
-    return line, doc
+    if varargs:
+        parts.append('*' + varargs)
+    elif kwonly:
+        parts.append('*')
+
+    for arg in kwonly:
+        parts.append(format_arg(arg, kwdefaults.get(arg, NO_DEFAULT)))
+
+    if keywords:
+        parts.append('**' + keywords)
+
+    return name + '(' + ', '.join(parts) + ')'
+
+def _build_func_doc(function):
+    """
+    returns the function's docstring formatted for listing, or None
+    """
+    import inspect
+
+    doc = inspect.getdoc(function)
+    if doc is None:
+        return None
+    return format_docstring(doc)
+
+# indent -> TextWrapper, see format_docstring
+_wrapper_cache = {}
 
 def format_docstring(docstring, indent=' '*4):
-    lines = []
-    for line in docstring.splitlines():
-        lines.append(fill(line, width=80, initial_indent=indent, subsequent_indent=indent))
-    return '\n'.join(lines)
+    wrapper = _wrapper_cache.get(indent)
+    if wrapper is None:
+        from textwrap import TextWrapper
+        wrapper = _wrapper_cache[indent] = TextWrapper(width=80,
+                initial_indent=indent, subsequent_indent=indent)
+
+    return '\n'.join(wrapper.fill(line) for line in docstring.splitlines())
+
+# raw co_filename -> absolute path, see _function_file
+_abspath_cache = {}
+
+def _function_file(function):
+    """
+    returns the absolute path of the file a function was defined in, without
+    touching the filesystem like inspect.getabsfile does
+    """
+    filename = function.__code__.co_filename
+    try:
+        return _abspath_cache[filename]
+    except KeyError:
+        path = _abspath_cache[filename] = os.path.abspath(filename)
+        return path
+
+def _is_function(value):
+    """
+    checks for a python function like inspect.isfunction. inspect is only
+    imported for objects that aren't plain functions but whose type has a
+    __code__, such as functions compiled by Nuitka, which patches
+    inspect.isfunction to accept them
+    """
+    if isinstance(value, FunctionType):
+        return True
+    if not hasattr(type(value), '__code__'):
+        return False
+
+    import inspect
+    return inspect.isfunction(value)
+
+def _keep(name, value, this_file, only_file, show_hidden):
+    """
+    decides whether a global should be exposed as a command by get_functions
+    """
+    if not show_hidden and name.startswith('_'):
+        return False
+    if not _is_function(value):
+        return False
+    dfile = _function_file(value)
+    return dfile != this_file and (not only_file or dfile == only_file)
 
 def get_functions(globals_dict, only_file=None, show_hidden=False):
     # collect all the functions
-    this_file = os.path.abspath(__file__)
-
-    def keep_item(name_value):
-        (name, value) = name_value
-        dfile = lambda: inspect.getabsfile(value)
-        is_hidden_name = lambda: name.startswith('_')
-
-        keep = True
-        keep = keep and (show_hidden or not is_hidden_name())
-        keep = keep and inspect.isfunction(value)
-        keep = keep and dfile() != this_file
-        keep = keep and (not only_file or dfile() == only_file) 
-        return keep
-    
-    return dict(filter(lambda i: i if keep_item(i) else None, globals_dict.items()))
+    this_file = _function_file(get_functions)
 
-def action_list_functions(functions):
-    print("Commands")
+    return {name: value for name, value in globals_dict.items()
+            if _keep(name, value, this_file, only_file, show_hidden)}
+
+# bumped whenever the format of the cached docstrings changes
+_DOC_CACHE_VERSION = 2
+
+def _doc_cache_path(commandfile):
+    """
+    returns the path of the on-disk docstring cache for a command file
+    """
+    import hashlib
+
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    if not isinstance(commandfile, bytes):
+        commandfile = commandfile.encode('utf-8')
+    digest = hashlib.md5(commandfile).hexdigest()
+    return os.path.join(cache_dir, 'pyrunner', digest + '.json')
+
+def _doc_cache_key(commandfile):
+    """
+    returns the header line of the docstring cache for a command file. It
+    changes whenever the command file or pyrunner itself is modified. Returns
+    None when either file can't be found.
+    """
+    import json
+
+    key = [_DOC_CACHE_VERSION, commandfile]
+    try:
+        for path in (commandfile, _function_file(get_functions)):
+            st = os.stat(path)
+            key.append([st.st_mtime, st.st_size])
+    except OSError:
+        return None
+    return json.dumps(key)
+
+def _load_docs(path, key):
+    """
+    returns the docstrings stored at path under the header key, else {}. Each
+    name maps to a [raw __doc__, formatted docstring] pair.
+    """
+    import json
+
+    try:
+        with open(path) as f:
+            if f.readline().rstrip('\n') != key:
+                return {}
+            docs = json.loads(f.read())
+    except (IOError, OSError, ValueError):
+        return {}
+    return docs if isinstance(docs, dict) else {}
+
+def _save_docs(path, key, docs):
+    """
+    writes the docstrings to path under the header key, ignoring any failure
+    since it's only a cache
+    """
+    import json
+
+    tmp = '{}.{}'.format(path, os.getpid())
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(tmp, 'w') as f:
+            f.write(key + '\n')
+            f.write(json.dumps(docs))
+        os.rename(tmp, path)
+    except (IOError, OSError, TypeError): # TypeError: a __doc__ json can't store
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+def action_list_functions(functions, commandfile=None):
+    """
+    prints the signature and docstring of every function. When commandfile is
+    given, the formatted docstrings are also cached on disk, and an entry is
+    reused while the function's __doc__ is unchanged. Signatures are always
+    rebuilt, since their default values are only known at runtime.
+    """
+    cached = {}
+    cache_key = cache_path = None
+    if commandfile is not None:
+        cache_key = _doc_cache_key(commandfile)
+        if cache_key is not None:
+            cache_path = _doc_cache_path(commandfile)
+            cached = _load_docs(cache_path, cache_key)
+
+    # docstrings can be assigned at runtime, so an entry is only trusted when
+    # the raw __doc__ it was formatted from is still the current one
+    docs = {}
+    changed = False
+    for name in functions:
+        raw = getattr(functions[name], '__doc__', None)
+        entry = cached.get(name)
+        if not (isinstance(entry, list) and len(entry) == 2 and entry[0] == raw):
+            entry = [raw, _build_func_doc(functions[name])]
+            changed = True
+        docs[name] = entry
+
+    if changed and cache_key is not None:
+        cached.update(docs)
+        _save_docs(cache_path, cache_key, cached)
+
+    buf = ["Commands\n"]
     for name in functions:
-        value = functions[name]
-        line, doc = _build_func_text(value, name)
-        print('- {}'.format(line))
+        buf.append('- {}\n'.format(_build_func_text(functions[name], name)))
+        doc = docs[name][1]
         if doc is not None:
-            print(format_docstring(doc))
+            buf.append(doc + '\n')
+
+    sys.stdout.write(''.join(buf))
 
 
-def main(globals_dict=None, args=None, commandfile=None,  default=DEFAULT_ACTION):
+# source -> code object, see _compile_call
+_code_cache = {}
+
+def _compile_call(source):
+    """
+    compiles a function call expression given on the command line, reusing
+    the code object if the same source has been compiled before
+    """
+    code = _code_cache.get(source)
+    if code is None:
+        # compiled outside of an except block so that a SyntaxError in the
+        # call isn't reported as chained onto a KeyError
+        code = _code_cache[source] = compile(source, '<pyrunner>', 'exec')
+    return code
+
+def main(globals_dict=None, args=None, commandfile=None,  default=DEFAULT_ACTION,
+         _getframe=sys._getframe, _abspath=os.path.abspath,
+         _intern=intern, _compile=_compile_call):
+    # the underscored keyword arguments bind globals to fast locals and are not
+    # meant to be passed by callers
+
     # preprocess all the arguments
     if args is None:
         args = sys.argv[1:]
     
-    parsed = parse_args(args)
+    if globals_dict is None or commandfile is None:
+        frame = _getframe(1)
+        if globals_dict is None:
+            globals_dict = frame.f_globals
+        if commandfile is None:
+            commandfile = _abspath(frame.f_code.co_filename)
+
+    # fast path for running the default function, which needs neither the
+    # parsed arguments nor a scan over all the globals
+    if not args:
+        this_file = _function_file(get_functions)
+        if _keep(default, globals_dict.get(default), this_file, commandfile, False):
+            exec(_compile(default + '()'), globals_dict, dict())
+            return
 
-    if globals_dict is None:
-        frame = sys._getframe(1)
-        globals_dict = frame.f_globals
+    parsed = parse_args(args)
 
-    if commandfile is None:
-        frame = sys._getframe(1)
-        finfo = inspect.getframeinfo(frame)
-        commandfile = os.path.abspath(finfo.filename)
-        
     functions = get_functions(globals_dict, only_file=commandfile, show_hidden=parsed.hidden)
 
     if parsed.list:
-        action_list_functions(functions)
+        action_list_functions(functions, commandfile)
         sys.exit(1)
 
     # --- begin the execution
-    if default in functions and not args:
-        exec(default + '()', globals_dict, dict())
-    elif not args: # then list the available commands
-        action_list_functions(functions)
+    if not args: # no default function, so list the available commands
+        action_list_functions(functions, commandfile)
         sys.exit(1)
     else:
-        # process any function calls
-        for i in parsed.function: # XXX name here is singular due to argparse
-            if '(' not in i:
-                i += '()'
-            name = i[:i.index('(')]
-            if name not in functions:
+        # check and compile every call before running any of them, so an
+        # unknown name or a syntax error doesn't leave a task half done
+        calls = []
+        for i in parsed.function:
+            name, paren, _ = i.partition('(')
+            calls.append((_intern(name), i if paren else i + '()'))
+
+        missing = [name for name, _ in calls if name not in functions]
+        if missing:
+            for name in missing:
                 print("{} is not a recognized function".format(name))
-                sys.exit(1)
-            exec(i, globals_dict, dict())
+            sys.exit(1)
 
-_patch_popen(Popen)
+        codes = [_compile(source) for _, source in calls]
+        for code in codes:
+            exec(code, globals_dict, dict())